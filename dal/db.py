@@ -1,24 +1,64 @@
 from tinydb import TinyDB, Query
+from tinydb.table import Document
+import atexit
 import os
 
 # DB paths
 BLESSINGS_DB = 'data/blessings.json'
 PAYMENTS_DB = 'data/payments.json'
 
+# Replica mode: for several server processes sharing the same data/ directory.
+# Each process reads from memory and picks up other workers' writes within
+# REFRESH_INTERVAL seconds.
+REPLICA_MODE = os.environ.get('VISHUWISH_REPLICA') == '1'
+REFRESH_INTERVAL = float(os.environ.get('VISHUWISH_REFRESH_INTERVAL', '1.0'))
+
 # Create directories if not exist
 os.makedirs('data', exist_ok=True)
 
+
+def _open(path):
+    if REPLICA_MODE:
+        # Imported here: it needs fcntl, which Windows lacks
+        from dal.replica import ReplicaStorage
+        db = TinyDB(path, storage=ReplicaStorage, refresh_interval=REFRESH_INTERVAL)
+        # Reads are in memory anyway, and a query cache could keep serving
+        # results built from data another worker has since changed
+        db.table(db.default_table_name, cache_size=0)
+        # Closing folds the journal back into the JSON file
+        atexit.register(db.close)
+        return db
+    return TinyDB(path)
+
+
 # Initialize TinyDB
-blessings_db = TinyDB(BLESSINGS_DB)
-payments_db = TinyDB(PAYMENTS_DB)
+blessings_db = _open(BLESSINGS_DB)
+payments_db = _open(PAYMENTS_DB)
+
+
+def _refresh(db):
+    if REPLICA_MODE:
+        db.storage.sync()
+
+
+def _insert(db, doc):
+    if not REPLICA_MODE:
+        db.insert(doc)
+        return
+    with db.storage.lock():
+        # Pick the ID ourselves: the table's cached next ID may already be
+        # taken by another worker
+        doc_id = db.storage.next_id(db.default_table_name)
+        db.insert(Document(doc, doc_id=doc_id))
 
 
 # --- Blessings ---
 def save_blessing(bless_id, data):
-    blessings_db.insert({'id': bless_id, **data})
+    _insert(blessings_db, {'id': bless_id, **data})
 
 
 def get_blessing(bless_id):
+    _refresh(blessings_db)
     Blessing = Query()
     result = blessings_db.get(Blessing.id == bless_id)
     return result
@@ -26,9 +66,10 @@ def get_blessing(bless_id):
 
 # --- Payments ---
 def save_payment(bless_id, payment_data):
-    payments_db.insert({'bless_id': bless_id, **payment_data})
+    _insert(payments_db, {'bless_id': bless_id, **payment_data})
 
 
 def get_all_payments(bless_id):
+    _refresh(payments_db)
     Payment = Query()
     return payments_db.search(Payment.bless_id == bless_id)
@@ -0,0 +1,296 @@
+"""
+In-memory TinyDB storage shared by several server processes.
+
+Every process keeps the whole store in memory. Writes are appended as
+per-document deltas to ``<path>.journal``; other processes notice the journal
+growing (a cheap ``stat``) and apply only the new lines. The journal is folded
+back into the JSON snapshot at ``<path>`` once it gets large, on startup and
+on close.
+
+All writes must happen inside ``lock()``.
+"""
+import copy
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from tinydb.storages import Storage
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class ReplicaStorage(Storage):
+    def __init__(self, path, refresh_interval=1.0, compact_bytes=64 * 1024):
+        if fcntl is None:
+            raise RuntimeError('Replica mode needs fcntl file locks, '
+                               'which this platform does not provide')
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.refresh_interval = refresh_interval
+        self.compact_bytes = compact_bytes
+
+        # _journal_lock guards the journal fd, offset and flock, and is held by
+        # the writing thread for all of lock(). _mutex only guards swapping
+        # _data, so reads never wait behind another process.
+        self._journal_lock = threading.RLock()
+        self._mutex = threading.Lock()
+        self._lock_fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        self._lock_depth = 0
+        self._writer = None
+        # Held open so its inode can't be reused while we still point at it
+        self._journal_fd = None
+        self._data = {}
+        self._max_ids = {}
+        self._offset = 0
+        self._checked_at = 0.0
+
+        with self.lock():
+            if self._offset:
+                self._compact()
+
+    # --- TinyDB storage interface ---
+    def read(self):
+        with self._mutex:
+            if self._writer == threading.get_ident():
+                # TinyDB is about to modify a table: copy only that one
+                return _CopyOnRead(self._data)
+            # Plain reads share the tables; sync swaps them rather than
+            # modifying them in place
+            return dict(self._data)
+
+    def write(self, data):
+        if self._writer != threading.get_ident():
+            # TinyDB may already have edited shared documents in place
+            with self._journal_lock:
+                if self._lock_fd is not None:
+                    self._reload()
+            raise RuntimeError('ReplicaStorage writes must happen inside lock()')
+        delta = _diff(self._data, data)
+        if not delta:
+            return
+        # Anything past our offset is left over from a crashed writer
+        os.ftruncate(self._journal_fd, self._offset)
+        line = (json.dumps(delta) + '\n').encode('utf-8')
+        _write_all(self._journal_fd, line)
+        os.fsync(self._journal_fd)
+        self._offset += len(line)
+        # Apply what other workers will read back, not our Python objects
+        self._replay(line)
+        if self._offset >= self.compact_bytes:
+            self._compact()
+
+    def close(self):
+        with self._journal_lock:
+            if self._lock_fd is None:
+                return
+            with self.lock():
+                if self._offset:
+                    self._compact()
+            os.close(self._journal_fd)
+            os.close(self._lock_fd)
+            self._journal_fd = None
+            self._lock_fd = None
+
+    # --- Replication ---
+    @contextmanager
+    def lock(self):
+        """Hold the writer lock, caught up with every other worker."""
+        with self._journal_lock:
+            if self._lock_fd is None:
+                raise RuntimeError('ReplicaStorage is closed')
+            if self._lock_depth == 0:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+                self._writer = threading.get_ident()
+            self._lock_depth += 1
+            try:
+                if self._lock_depth == 1:
+                    self._sync(force=True)
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    self._writer = None
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def sync(self, force=False):
+        """Apply journal entries written by other workers.
+
+        Checks at most once every ``refresh_interval`` seconds unless forced.
+        Never waits: if another thread is syncing or writing, the current
+        in-memory copy is kept. Returns True if it changed.
+        """
+        if not self._journal_lock.acquire(blocking=False):
+            return False
+        try:
+            if self._lock_fd is None:
+                return False
+            return self._sync(force)
+        finally:
+            self._journal_lock.release()
+
+    def next_id(self, table):
+        """Next free document ID in ``table``; call inside ``lock()``."""
+        return self._max_ids.get(table, 0) + 1
+
+    def _sync(self, force):
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.refresh_interval:
+            return False
+
+        if self._journal_replaced():
+            # Compacted (or first open): start again from the snapshot
+            if not self._reload(blocking=False):
+                return False
+            self._checked_at = now
+            return True
+        self._checked_at = now
+        size = os.fstat(self._journal_fd).st_size
+        if size <= self._offset:
+            return False
+        chunk = os.pread(self._journal_fd, size - self._offset, self._offset)
+        # A writer may be mid-append; leave a partial last line for next time
+        end = chunk.rfind(b'\n') + 1
+        self._replay(chunk[:end])
+        self._offset += end
+        return end > 0
+
+    def _journal_replaced(self):
+        if self._journal_fd is None:
+            return True
+        held = os.fstat(self._journal_fd)
+        try:
+            current = os.stat(self.journal_path)
+        except FileNotFoundError:
+            return True
+        return (held.st_dev, held.st_ino) != (current.st_dev, current.st_ino)
+
+    def _reload(self, blocking=True):
+        """Rebuild from the snapshot and journal; call with _journal_lock held.
+
+        Outside lock() this takes a shared flock; with ``blocking=False`` it
+        gives up (returning False) while another process is writing.
+        """
+        if self._lock_depth == 0:
+            try:
+                fcntl.flock(self._lock_fd,
+                            fcntl.LOCK_SH | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                return False
+        try:
+            if self._journal_fd is not None:
+                os.close(self._journal_fd)
+            self._journal_fd = os.open(
+                self.journal_path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                with open(self.path, encoding='utf-8') as snapshot:
+                    data = json.loads(snapshot.read() or '{}')
+            except FileNotFoundError:
+                data = {}
+            self._max_ids = {table: max(map(int, docs), default=0)
+                             for table, docs in data.items()}
+            size = os.fstat(self._journal_fd).st_size
+            chunk = os.pread(self._journal_fd, size, 0)
+            end = chunk.rfind(b'\n') + 1
+            # Deltas replay idempotently, so entries already in the snapshot
+            # (a crash between the two replaces in _compact) are harmless
+            self._replay(chunk[:end], data)
+            self._offset = end
+            return True
+        finally:
+            if self._lock_depth == 0:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _replay(self, lines, data=None):
+        """Apply journal lines to a copy of ``data`` and swap it in."""
+        data = dict(self._data if data is None else data)
+        copied = set()
+        for line in lines.splitlines():
+            delta = json.loads(line)
+            _apply(data, delta, copied)
+            for table, change in delta.items():
+                if change is None:
+                    self._max_ids.pop(table, None)
+                elif change['set']:
+                    top = max(map(int, change['set']))
+                    self._max_ids[table] = max(self._max_ids.get(table, 0), top)
+        with self._mutex:
+            self._data = data
+
+    def _compact(self):
+        _replace(self.path, json.dumps(self._data).encode('utf-8'))
+        _replace(self.journal_path, b'')
+        os.close(self._journal_fd)
+        self._journal_fd = os.open(
+            self.journal_path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self._offset = 0
+
+
+class _CopyOnRead(dict):
+    """Tables for one read-modify-write; a table is deep-copied when accessed."""
+
+    def __init__(self, tables):
+        super().__init__(tables)
+        self._copied = set()
+
+    def __getitem__(self, name):
+        table = super().__getitem__(name)
+        if name not in self._copied:
+            table = copy.deepcopy(table)
+            self[name] = table
+            self._copied.add(name)
+        return table
+
+
+def _diff(old, new):
+    delta = {}
+    for table in old:
+        if table not in new:
+            delta[table] = None
+    for table, docs in new.items():
+        before = old.get(table)
+        if docs is before:
+            continue  # never handed out for writing
+        before = before or {}
+        changed = {doc_id: doc for doc_id, doc in docs.items()
+                   if before.get(doc_id) != doc}
+        removed = [doc_id for doc_id in before if doc_id not in docs]
+        if changed or removed or table not in old:
+            delta[table] = {'set': changed, 'del': removed}
+    return delta
+
+
+def _apply(data, delta, copied):
+    # Tables may be shared with readers, so copy each one before editing it
+    # (once per table per batch)
+    for table, change in delta.items():
+        if change is None:
+            data.pop(table, None)
+            copied.discard(table)
+            continue
+        if table not in copied:
+            data[table] = dict(data.get(table, {}))
+            copied.add(table)
+        docs = data[table]
+        docs.update(change['set'])
+        for doc_id in change['del']:
+            docs.pop(doc_id, None)
+
+
+def _write_all(fd, content):
+    view = memoryview(content)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _replace(path, content):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
@@ -0,0 +1,197 @@
+import fcntl
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+from tinydb import TinyDB
+from tinydb.table import Document
+
+from dal import replica
+from dal.replica import ReplicaStorage, _replace
+
+
+def _open(path, **kwargs):
+    # Same as dal.db._open in replica mode
+    db = TinyDB(str(path), storage=ReplicaStorage, **kwargs)
+    db.table(db.default_table_name, cache_size=0)
+    return db
+
+
+def _insert(db, doc):
+    # Same as dal.db._insert in replica mode
+    with db.storage.lock():
+        db.insert(Document(doc, doc_id=db.storage.next_id(db.default_table_name)))
+
+
+def _insert_many(path, worker, count):
+    db = _open(path, compact_bytes=500)
+    for i in range(count):
+        _insert(db, {'worker': worker, 'i': i})
+    db.close()
+
+
+def test_concurrent_inserts_get_unique_ids(tmp_path):
+    path = tmp_path / 'db.json'
+    workers = [multiprocessing.Process(target=_insert_many, args=(str(path), w, 50))
+               for w in range(4)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+        assert p.exitcode == 0
+
+    docs = TinyDB(str(path)).all()
+    assert len(docs) == 200
+    assert len({d.doc_id for d in docs}) == 200
+    assert {(d['worker'], d['i']) for d in docs} == {(w, i) for w in range(4) for i in range(50)}
+
+
+def test_other_workers_writes_visible_after_refresh_interval(tmp_path):
+    path = tmp_path / 'db.json'
+    reader = _open(path, refresh_interval=0.2)
+    assert reader.all() == []
+
+    writer = multiprocessing.Process(target=_insert_many, args=(str(path), 0, 1))
+    writer.start()
+    writer.join()
+
+    time.sleep(0.25)
+    assert reader.storage.sync()
+    assert [dict(d) for d in reader.all()] == [{'worker': 0, 'i': 0}]
+
+
+def _hold_lock(path, ready, seconds):
+    fd = os.open(str(path) + '.lock', os.O_RDWR)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    ready.set()
+    time.sleep(seconds)
+    os.close(fd)
+
+
+def test_reads_do_not_wait_for_another_processes_writer(tmp_path):
+    path = tmp_path / 'db.json'
+    db = _open(path, refresh_interval=0)
+    _insert(db, {'i': 0})
+
+    ready = multiprocessing.Event()
+    holder = multiprocessing.Process(target=_hold_lock, args=(path, ready, 1.5))
+    holder.start()
+    ready.wait()
+    # This thread waits for the other process inside lock()
+    writer = threading.Thread(target=_insert, args=(db, {'i': 1}))
+    writer.start()
+    time.sleep(0.1)
+
+    started = time.monotonic()
+    db.storage.sync()
+    assert [d['i'] for d in db.all()] == [0]
+    assert time.monotonic() - started < 0.5
+
+    writer.join()
+    holder.join()
+    assert [d['i'] for d in db.all()] == [0, 1]
+
+
+def test_writer_holds_the_same_data_as_other_replicas(tmp_path):
+    path = tmp_path / 'db.json'
+    writer = _open(path)
+    reader = _open(path, refresh_interval=0)
+    _insert(writer, {'t': (1, 2), 'n': {1: 'a'}})
+
+    reader.storage.sync()
+    assert writer.all() == reader.all() == [{'t': [1, 2], 'n': {'1': 'a'}}]
+
+
+def test_short_journal_writes_are_completed(tmp_path, monkeypatch):
+    path = tmp_path / 'db.json'
+    db = _open(path)
+    real_write = os.write
+    monkeypatch.setattr(replica.os, 'write', lambda fd, data: real_write(fd, data[:7]))
+    _insert(db, {'i': 0})
+    _insert(db, {'i': 1})
+    monkeypatch.undo()
+
+    assert [d['i'] for d in _open(path).all()] == [0, 1]
+
+
+def test_reader_survives_several_compactions(tmp_path):
+    path = tmp_path / 'db.json'
+    writer = _open(path, compact_bytes=300)
+    reader = _open(path, refresh_interval=0)
+
+    for i in range(10):
+        _insert(writer, {'i': i})
+    assert reader.storage.sync()
+    for i in range(10, 60):
+        _insert(writer, {'i': i})
+
+    reader.storage.sync()
+    assert reader.storage.read() == writer.storage.read()
+    assert len(reader.all()) == 60
+
+
+def test_replays_journal_after_crash_between_snapshot_and_journal_replace(tmp_path):
+    path = tmp_path / 'db.json'
+    db = _open(path)
+    _insert(db, {'name': 'a'})
+    _insert(db, {'name': 'b'})
+    with db.storage.lock():
+        db.update({'name': 'c'}, doc_ids=[1])
+        db.remove(doc_ids=[2])
+    expected = db.storage.read()
+
+    # The snapshot is written, then the process dies before the journal is reset
+    _replace(str(path), json.dumps(expected).encode('utf-8'))
+    assert os.path.getsize(str(path) + '.journal') > 0
+
+    reopened = _open(path)
+    assert reopened.storage.read() == expected
+    assert reopened.storage.next_id('_default') == 3
+
+
+def test_torn_append_is_discarded(tmp_path):
+    path = tmp_path / 'db.json'
+    db = _open(path)
+    _insert(db, {'i': 0})
+    with open(str(path) + '.journal', 'ab') as journal:
+        journal.write(b'{"_default": {"set": {"2"')
+
+    _insert(db, {'i': 1})
+
+    reader = _open(path)
+    assert [d['i'] for d in reader.all()] == [0, 1]
+
+
+def test_close_folds_journal_into_snapshot(tmp_path):
+    path = tmp_path / 'db.json'
+    db = _open(path)
+    for i in range(5):
+        _insert(db, {'i': i})
+    db.close()
+
+    assert os.path.getsize(str(path) + '.journal') == 0
+    assert len(TinyDB(str(path)).all()) == 5
+
+
+def test_write_outside_lock_raises(tmp_path):
+    path = tmp_path / 'db.json'
+    db = _open(path)
+    _insert(db, {'i': 0})
+
+    with pytest.raises(RuntimeError):
+        db.update({'i': 1}, doc_ids=[1])
+    assert [dict(d) for d in db.all()] == [{'i': 0}]
+
+
+def test_closed_storage_stops_syncing(tmp_path):
+    path = tmp_path / 'db.json'
+    db = _open(path, refresh_interval=0)
+    db.close()
+
+    assert not db.storage.sync(force=True)
+    with pytest.raises(RuntimeError):
+        with db.storage.lock():
+            pass